@@ -1,10 +1,6 @@
 #!/usr/bin/env python
 
-# from PyQt5 import QtCore as QtC, QtWidgets as QtW, QtGui as QtG
-from PyQt5 import QtWidgets as QtW
-
 from aperoll.utils import AperollException, logger
-from aperoll.widgets.main_window import MainWindow
 
 
 def get_parser():
@@ -27,6 +23,11 @@ def main():
 
     logger.setLevel(args.log_level)
 
+    # the GUI modules are imported after parsing arguments, so --help does not have to wait
+    from PyQt5 import QtWidgets as QtW
+
+    from aperoll.widgets.main_window import MainWindow
+
     try:
         app = QtW.QApplication([])
         w = MainWindow(opts=vars(args))
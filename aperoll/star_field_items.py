@@ -2,6 +2,8 @@
 Collection of QGraphicsItem subclasses to represent star field items in the star field view.
 """
 
+import functools
+
 import numpy as np
 from astropy.table import Table
 from chandra_aca.transform import (
@@ -84,6 +86,20 @@ def star_field_position(
     return row, -col
 
 
+def qpolygonf(x, y):
+    """
+    Make a QPolygonF from arrays of coordinates, filling its buffer directly with numpy.
+    """
+    polygon = QtG.QPolygonF()
+    polygon.fill(QtC.QPointF(), len(x))
+    buffer = polygon.data()
+    buffer.setsize(2 * len(x) * np.dtype(np.float64).itemsize)
+    points = np.frombuffer(buffer, dtype=np.float64).reshape(-1, 2)
+    points[:, 0] = x
+    points[:, 1] = y
+    return polygon
+
+
 def symsize(mag):
     """
     Symbol size for a star of a given magnitude.
@@ -95,6 +111,17 @@ def symsize(mag):
     return np.interp(mag, [6.0, 11.0], [32.0, 8.0])
 
 
+@functools.cache
+def _star_pen_and_brush(rgba):
+    """
+    Pen and brush for stars of a given color.
+
+    There are only a few star colors, so all stars of the same color share one pen and brush.
+    """
+    color = QtG.QColor.fromRgba(rgba)
+    return QtG.QPen(color), QtG.QBrush(color)
+
+
 class Star(QtW.QGraphicsEllipseItem):
     """
     QGraphicsItem representing a star.
@@ -117,18 +144,22 @@ class Star(QtW.QGraphicsEllipseItem):
         The parent item.
     highlight : bool, optional
         If True, the star is highlighted in red.
+    bad : bool, optional
+        Whether the star is not an acquisition candidate. If not given, it is calculated from the
+        star. Pass it when creating many stars, so it can be calculated for all of them at once.
     """
 
-    def __init__(self, star, parent=None, highlight=False):
+    def __init__(self, star, parent=None, highlight=False, bad=None):
         s = symsize(star["MAG_ACA"])
         rect = QtC.QRectF(-s / 2, -s / 2, s, s)
         super().__init__(rect, parent)
         # self._stars = Table([star], names=star.colnames, dtype=star.dtype)
         self.star = star
         self.highlight = highlight
-        color = self.color()
-        self.setBrush(QtG.QBrush(color))
-        self.setPen(QtG.QPen(color))
+        self._bad = bad
+        pen, brush = _star_pen_and_brush(self.color().rgba())
+        self.setBrush(brush)
+        self.setPen(pen)
         self.included = {
             "acq": None,
             "guide": None,
@@ -151,7 +182,9 @@ class Star(QtW.QGraphicsEllipseItem):
         return QtG.QColor("black")
 
     def bad(self):
-        return not get_acq_candidates_mask(self.star)
+        if self._bad is None:
+            self._bad = not get_acq_candidates_mask(self.star)
+        return self._bad
 
     def text(self):
         return (
@@ -620,6 +653,8 @@ class CameraOutline(QtW.QGraphicsItem):
         super().__init__(parent)
         self.simple = simple
         self._frame = utils.get_camera_fov_frame()
+        # the outline in scene coordinates, updated when the scene attitude changes
+        self._polygons = None
         self.attitude = attitude
         self.setZValue(100)
 
@@ -629,7 +664,7 @@ class CameraOutline(QtW.QGraphicsItem):
         return QtC.QRectF(-w, -w, 2 * w, 2 * w)
 
     def paint(self, painter, _option, _widget):
-        if "x" not in self._frame["edge_1"]:
+        if self._polygons is None:
             if self.scene() is not None and self.scene().attitude is not None:
                 self.set_pos_for_attitude(self.scene().attitude)
             else:
@@ -647,55 +682,19 @@ class CameraOutline(QtW.QGraphicsItem):
         painter.setRenderHint(QtG.QPainter.Antialiasing, True)
 
         painter.setPen(pen)
-        for i in range(len(self._frame["edge_1"]["x"]) - 1):
-            painter.drawLine(
-                QtC.QPointF(
-                    self._frame["edge_1"]["x"][i], self._frame["edge_1"]["y"][i]
-                ),
-                QtC.QPointF(
-                    self._frame["edge_1"]["x"][i + 1],
-                    self._frame["edge_1"]["y"][i + 1],
-                ),
-            )
+        painter.drawPolyline(self._polygons["edge_1"])
         if self.simple:
             painter.setRenderHint(QtG.QPainter.Antialiasing, anti_aliasing_set)
             return
 
-        for i in range(len(self._frame["edge_2"]["x"]) - 1):
-            painter.drawLine(
-                QtC.QPointF(
-                    self._frame["edge_2"]["x"][i], self._frame["edge_2"]["y"][i]
-                ),
-                QtC.QPointF(
-                    self._frame["edge_2"]["x"][i + 1],
-                    self._frame["edge_2"]["y"][i + 1],
-                ),
-            )
+        painter.drawPolyline(self._polygons["edge_2"])
 
         magenta_pen = QtG.QPen(QtG.QColor("magenta"))
         magenta_pen.setCosmetic(True)
         magenta_pen.setWidth(1)
         painter.setPen(magenta_pen)
-        for i in range(len(self._frame["cross_2"]["x"]) - 1):
-            painter.drawLine(
-                QtC.QPointF(
-                    self._frame["cross_2"]["x"][i], self._frame["cross_2"]["y"][i]
-                ),
-                QtC.QPointF(
-                    self._frame["cross_2"]["x"][i + 1],
-                    self._frame["cross_2"]["y"][i + 1],
-                ),
-            )
-        for i in range(len(self._frame["cross_1"]["x"]) - 1):
-            painter.drawLine(
-                QtC.QPointF(
-                    self._frame["cross_1"]["x"][i], self._frame["cross_1"]["y"][i]
-                ),
-                QtC.QPointF(
-                    self._frame["cross_1"]["x"][i + 1],
-                    self._frame["cross_1"]["y"][i + 1],
-                ),
-            )
+        painter.drawPolyline(self._polygons["cross_2"])
+        painter.drawPolyline(self._polygons["cross_1"])
 
         painter.setRenderHint(QtG.QPainter.Antialiasing, anti_aliasing_set)
 
@@ -715,6 +714,9 @@ class CameraOutline(QtW.QGraphicsItem):
                 ra=self._frame[key]["ra"],
                 dec=self._frame[key]["dec"],
             )
+        self._polygons = {
+            key: qpolygonf(value["x"], value["y"]) for key, value in self._frame.items()
+        }
 
         self.update()
 
@@ -0,0 +1,25 @@
+import pickle
+
+import pytest
+
+from aperoll.utils import compute_catalog, get_review_table
+
+pytest.importorskip("proseco")
+pytest.importorskip("sparkles")
+
+
+def test_review_messages_after_pickle():
+    # compute_catalog runs in a worker process, so the catalog reaches the GUI pickled
+    from proseco.core import StarsTable
+    from proseco.tests.common import DARK40, mod_std_info
+
+    # too few stars for a complete catalog, so sparkles has something to say
+    stars = StarsTable.empty()
+    stars.add_fake_constellation(n_stars=3, mag=10.25)
+    catalog = compute_catalog(mod_std_info(stars=stars, dark=DARK40))
+
+    expected = get_review_table(catalog).messages
+    assert len(expected) > 0
+
+    aca = get_review_table(pickle.loads(pickle.dumps(catalog)))
+    assert aca.messages == expected
@@ -1,3 +1,10 @@
+import functools
+import gzip
+import os
+import pickle
+import shutil
+from pathlib import Path
+
 import numpy as np
 from chandra_aca.transform import (
     pixels_to_yagzag,
@@ -8,63 +15,184 @@ from ska_helpers import logging
 logger = logging.basic_logger("aperoll")
 
 
-# The nominal origin of the CCD, in pixel coordinates (yagzag_to_pixels(0, 0))
-CCD_ORIGIN = yagzag_to_pixels(
-    0, 0
-)  # (6.08840495576943, 4.92618563916467) as of this writing
-# The (0,0) point of the CCD coordinates in (yag, zag)
-YZ_ORIGIN = pixels_to_yagzag(0, 0)
+def __getattr__(name):
+    # CCD_ORIGIN and YZ_ORIGIN are computed on first access (PEP 562), so importing this module
+    # does not require any coordinate transformation.
+    if name == "CCD_ORIGIN":
+        # The nominal origin of the CCD, in pixel coordinates (yagzag_to_pixels(0, 0))
+        # (6.08840495576943, 4.92618563916467) as of this writing
+        value = yagzag_to_pixels(0, 0)
+    elif name == "YZ_ORIGIN":
+        # The (0,0) point of the CCD coordinates in (yag, zag)
+        value = pixels_to_yagzag(0, 0)
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
 
 
 class AperollException(RuntimeError):
     pass
 
 
+def load_catalogs(filename):
+    """
+    Load a dictionary of proseco catalogs from a pickle file (.pkl or .pkl.gz).
+
+    The result for the last file is cached, so the same file is not unpickled again unless it is
+    modified. The returned dictionary is shared between callers, so it must not be modified.
+    Call `clear_catalogs_cache` when the catalogs are not needed anymore.
+    """
+    filename = str(filename)
+    return _load_catalogs(filename, os.path.getmtime(filename))
+
+
+def clear_catalogs_cache():
+    """
+    Release the catalogs cached by `load_catalogs`.
+    """
+    _load_catalogs.cache_clear()
+
+
+# pickle reads many small chunks (at least for protocols without framing), so uncompressed files
+# are read through a buffer larger than the default, with fewer system calls
+_PICKLE_BUFFER_SIZE = 1 << 20
+
+
+@functools.lru_cache(maxsize=1)
+def _load_catalogs(filename, _mtime):
+    if filename.endswith(".gz"):
+        # GzipFile is already buffered, so it is not wrapped in another buffer
+        with gzip.open(filename, "rb") as fh:
+            return pickle.load(fh)
+    with open(filename, "rb", buffering=_PICKLE_BUFFER_SIZE) as fh:
+        return pickle.load(fh)
+
+
+def compute_catalog(parameters):
+    """
+    Compute a star catalog with proseco.
+
+    This is meant to run in a worker process. proseco reads the AGASC HDF5 files, and HDF5 can not
+    be used from several threads at once.
+
+    Returns the catalog, or None if there are no parameters. The review table is not computed
+    here, because the sparkles messages are not kept when a review table is pickled. Use
+    `get_review_table` on the result instead.
+    """
+    # proseco is slow to import, and the aperoll script imports this module before parsing its
+    # arguments
+    from proseco import get_aca_catalog
+
+    if parameters:
+        return get_aca_catalog(**parameters)
+
+
+def get_review_table(catalog):
+    """
+    Get the review table of a proseco catalog, with the sparkles checks already run.
+    """
+    import sparkles
+
+    aca = catalog.get_review_table()
+    sparkles.core.check_catalog(aca)
+    return aca
+
+
+def run_sparkles_review(catalog, report_dir):
+    """
+    Write the sparkles report for a catalog in `report_dir`, replacing any previous report.
+
+    Like `compute_catalog`, this is meant to run in a worker process. Returns the report
+    directory, or None if there is no catalog.
+    """
+    import sparkles
+
+    if not catalog:
+        return None
+
+    report_dir = Path(report_dir)
+    shutil.rmtree(report_dir, ignore_errors=True)
+    report_dir.mkdir()
+    sparkles.run_aca_review(
+        "Exploration",
+        acars=[catalog.get_review_table()],
+        report_dir=report_dir,
+        report_level="all",
+        roll_level="none",
+    )
+    return report_dir
+
+
 def get_camera_fov_frame():
     """
     Paths that correspond ot the edges of the ACA CCD and the quadrant boundaries.
+
+    The frame is constant, so it is computed only once. Each call returns a new dictionary, so
+    callers can add entries to it, but the arrays are shared and read-only.
+    """
+    return {key: dict(value) for key, value in _get_camera_fov_frame().items()}
+
+
+def _rectangle_path(row_max, col_max, n_points):
+    """
+    Path (as row and col arrays) around a rectangle centered at the origin.
+
+    Each side has `n_points` points, so corners appear twice. The path starts at
+    (-row_max, -col_max), goes around the rectangle back to that corner, and then has one more
+    point at (-row_max, 0), in the middle of the first side.
     """
+    rows = np.linspace(-row_max, row_max, n_points)
+    cols = np.linspace(-col_max, col_max, n_points)
+    row = np.concatenate(
+        [np.full(n_points, -row_max), rows, np.full(n_points, row_max), rows[::-1]]
+        + [[-row_max]]
+    )
+    col = np.concatenate(
+        [cols, np.full(n_points, col_max), cols[::-1], np.full(n_points, -col_max)]
+        + [[0]]
+    )
+    return row, col
+
+
+@functools.cache
+def _get_camera_fov_frame():
     frame = {}
     N = 100
-    edge_1 = np.array(
-        [[-520, i] for i in np.linspace(-512, 512, N)]
-        + [[i, 512] for i in np.linspace(-520, 520, N)]
-        + [[520, i] for i in np.linspace(512, -512, N)]
-        + [[i, -512] for i in np.linspace(520, -520, N)]
-        + [[-520, 0]]
-    ).T
+    row, col = _rectangle_path(520, 512, N)
     frame["edge_1"] = {
-        "row": edge_1[0],
-        "col": edge_1[1],
+        "row": row,
+        "col": col,
     }
 
-    edge_2 = np.array(
-        [[-512, i] for i in np.linspace(-512, 512, N)]
-        + [[i, 512] for i in np.linspace(-512, 512, N)]
-        + [[512, i] for i in np.linspace(512, -512, N)]
-        + [[i, -512] for i in np.linspace(512, -512, N)]
-        + [[-512, 0]]
-    ).T
+    row, col = _rectangle_path(512, 512, N)
     frame["edge_2"] = {
-        "row": edge_2[0],
-        "col": edge_2[1],
+        "row": row,
+        "col": col,
     }
 
-    cross_2 = np.array([[i, 0] for i in np.linspace(-511, 511, N)]).T
     frame["cross_2"] = {
-        "row": cross_2[0],
-        "col": cross_2[1],
+        "row": np.linspace(-511, 511, N),
+        "col": np.zeros(N),
     }
 
-    cross_1 = np.array([[0, i] for i in np.linspace(-511, 511, N)]).T
     frame["cross_1"] = {
-        "row": cross_1[0],
-        "col": cross_1[1],
+        "row": np.zeros(N),
+        "col": np.linspace(-511, 511, N),
     }
 
-    for value in frame.values():
-        value["yag"], value["zag"] = pixels_to_yagzag(
-            value["row"], value["col"], allow_bad=True
-        )
+    # transform all paths in a single call and split the result afterwards
+    yag, zag = pixels_to_yagzag(
+        np.concatenate([value["row"] for value in frame.values()]),
+        np.concatenate([value["col"] for value in frame.values()]),
+        allow_bad=True,
+    )
+    sections = np.cumsum([len(value["row"]) for value in frame.values()])[:-1]
+    for value, value_yag, value_zag in zip(
+        frame.values(), np.split(yag, sections), np.split(zag, sections), strict=True
+    ):
+        value["yag"], value["zag"] = value_yag, value_zag
+        for arr in value.values():
+            arr.setflags(write=False)
 
     return frame
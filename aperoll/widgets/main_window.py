@@ -1,25 +1,31 @@
 # from PyQt5 import QtCore as QtC, QtWidgets as QtW, QtGui as QtG
-import gzip
+import functools
+import multiprocessing
 import os
 import pickle
 import tarfile
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
 from pathlib import Path
 from tempfile import TemporaryDirectory
 
-import numpy as np
 import PyQt5.QtWebEngineWidgets as QtWe
 import PyQt5.QtWidgets as QtW
-import sparkles
 from astropy import units as u
 from cxotime import CxoTime
-from proseco import get_aca_catalog
 from PyQt5 import QtCore as QtC
 from Quaternion import Quat
-from ska_helpers import utils
 
-from aperoll.utils import logger
+from aperoll.utils import (
+    clear_catalogs_cache,
+    compute_catalog,
+    get_review_table,
+    load_catalogs,
+    logger,
+    run_sparkles_review,
+)
 
-from .parameters import Parameters
+from .parameters import Parameters, clear_default_parameters_cache
 from .star_plot import StarPlot
 from .starcat_view import StarcatView
 
@@ -105,6 +111,10 @@ class WebPage(QtWe.QWebEnginePage):
 
 
 class MainWindow(QtW.QMainWindow):
+    # these signals are emitted from worker threads when the computations finish
+    proseco_done = QtC.pyqtSignal(object)
+    sparkles_done = QtC.pyqtSignal(object)
+
     def __init__(self, opts=None):  # noqa: PLR0915
         super().__init__()
         opts = {} if opts is None else opts
@@ -147,13 +157,21 @@ class MainWindow(QtW.QMainWindow):
         self.plot.include_star.connect(self.parameters.include_star)
         # self.plot.exclude_star.connect(self.parameters.exclude_star)
 
+        # automatic catalog updates are delayed a bit, so bursts of changes result in one update
+        self._auto_proseco_timer = QtC.QTimer(self)
+        self._auto_proseco_timer.setSingleShot(True)
+        self._auto_proseco_timer.setInterval(150)
+        self._auto_proseco_timer.timeout.connect(self._run_proseco)
+
         self.parameters.do_it.connect(self._run_proseco)
-        self.plot.update_proseco.connect(self._run_proseco)
+        self.plot.update_proseco.connect(self._auto_proseco_timer.start)
         self.parameters.run_sparkles.connect(self._run_sparkles)
         self.parameters.reset.connect(self._reset)
         self.parameters.draw_test.connect(self._draw_test)
         self.parameters.parameters_changed.connect(self._parameters_changed)
         self.plot.attitude_changed.connect(self.parameters.set_ra_dec)
+        self.proseco_done.connect(self._show_proseco)
+        self.sparkles_done.connect(self._show_sparkles)
 
         self._data = Data(self.parameters.proseco_args())
         self.outdir = Path(os.getcwd())
@@ -164,20 +182,17 @@ class MainWindow(QtW.QMainWindow):
         if "file" in opts:
             filename = opts.get("file")
             catalogs = {}
-            if filename.endswith(".pkl"):
-                with open(filename, "rb") as fh:
-                    catalogs = pickle.load(fh)
-            elif filename.endswith(".pkl.gz"):
-                with gzip.open(filename, "rb") as fh:
-                    catalogs = pickle.load(fh)
+            if filename.endswith((".pkl", ".pkl.gz")):
+                catalogs = load_catalogs(filename)
             if catalogs:
-                obsids = [int(np.round(float(k))) for k in catalogs]
                 if "obsid" not in opts or opts["obsid"] is None:
-                    starcat = catalogs[obsids[0]]
+                    starcat = catalogs[next(iter(catalogs))]
                 else:
                     starcat = catalogs[opts["obsid"]]
-                aca = starcat.get_review_table()
-                sparkles.core.check_catalog(aca)
+                aca = get_review_table(starcat)
+            # the file is only read for the parameters and for this catalog, so the other
+            # catalogs in it are released
+            clear_catalogs_cache()
 
         if starcat is not None:
             self.plot.set_catalog(starcat)
@@ -192,14 +207,18 @@ class MainWindow(QtW.QMainWindow):
         if self.web_page is not None:
             del self.web_page
             self.web_page = None
+        self._data.close()
         event.accept()
 
     def _parameters_changed(self):
+        # values are empty while the parameters are not valid, so there is nothing to compute
+        if not self.parameters.values:
+            return
         proseco_args = self.parameters.proseco_args()
         self.plot.set_base_attitude(proseco_args["att"])
         self._data.reset(proseco_args)
         if self.plot.scene.state.auto_proseco and not self.plot.view.moving:
-            self._run_proseco()
+            self._auto_proseco_timer.start()
 
     def _init(self):
         if self.parameters.values:
@@ -209,14 +228,21 @@ class MainWindow(QtW.QMainWindow):
             aca_attitude = Quat(
                 equatorial=(float(ra / u.deg), float(dec / u.deg), roll)
             )
-            self.plot.set_base_attitude(aca_attitude)
-            self.plot.set_time(time)
+            # attitude and time both change the stars, which are loaded only once
+            with self.plot.scene.batched_updates():
+                self.plot.set_base_attitude(aca_attitude)
+                self.plot.set_time(time)
+            # attitude_changed was emitted before the stars were loaded, so the new star items
+            # have not been scaled yet
+            self.plot.view.set_item_scale()
             self.plot.scene.state = "Proseco"
 
     def _reset(self):
+        # Reset reads telemetry again instead of using values cached during the last minute
+        clear_default_parameters_cache()
         self.parameters.set_parameters(**self.opts)
         self.starcat_view.reset()
-        self._data.reset(self.parameters.proseco_args())
+        self._data.reset(self.parameters.proseco_args(), force=True)
         self._init()
 
     def _draw_test(self):
@@ -232,19 +258,33 @@ class MainWindow(QtW.QMainWindow):
             )
 
     def _run_proseco(self):
+        """
+        Start computing the star catalog. It is displayed when the computation finishes.
+        """
+        self._data.submit_proseco().add_done_callback(self.proseco_done.emit)
+
+    def _show_proseco(self, future):
         """
         Display the star catalog.
         """
-        if self._data.proseco:
-            self.starcat_view.set_catalog(self._data.proseco["aca"])
-            self.plot.set_catalog(self._data.proseco["catalog"])
+        # results from parameters that changed in the meantime are discarded
+        if future is not self._data.proseco_future or future.cancelled():
+            return
+        if future.exception() is not None:
+            logger.warning(future.exception())
+            return
+        catalog = future.result()
+        if catalog:
+            # the review table is made here, because its messages would not survive pickling
+            self.starcat_view.set_catalog(get_review_table(catalog))
+            self.plot.set_catalog(catalog)
 
     def _export_proseco(self):
         """
         Save the star catalog in a pickle file.
         """
-        if self._data.proseco:
-            catalog = self._data.proseco["catalog"]
+        catalog = self._data.proseco
+        if catalog:
             dialog = QtW.QFileDialog(
                 self,
                 "Export Pickle",
@@ -261,7 +301,7 @@ class MainWindow(QtW.QMainWindow):
         Save the sparkles report to a tarball.
         """
         if self._data.sparkles:
-            catalog = self._data.proseco["catalog"]
+            catalog = self._data.proseco
             # for some reason, the extension hidden but it works
             dialog = QtW.QFileDialog(
                 self,
@@ -275,10 +315,21 @@ class MainWindow(QtW.QMainWindow):
                 self._data.export_sparkles(dialog.selectedFiles()[0])
 
     def _run_sparkles(self):
+        """
+        Start the sparkles review. The report is displayed when the review finishes.
+        """
+        self._data.submit_sparkles().add_done_callback(self.sparkles_done.emit)
+
+    def _show_sparkles(self, future):
         """
         Display the sparkles report in a web browser.
         """
-        if self._data.sparkles:
+        if future is not self._data.sparkles_future or future.cancelled():
+            return
+        if future.exception() is not None:
+            logger.warning(future.exception())
+            return
+        if future.result():
             try:
                 w = QtW.QMainWindow(self)
                 w.resize(1400, 1000)
@@ -294,79 +345,221 @@ class MainWindow(QtW.QMainWindow):
                 logger.warning(e)
 
 
+def _add_file_to_tar(tar, path, arcname):
+    """
+    Add a regular file to an open tarfile using a single stat call.
+
+    TarFile.add works out the file type, ownership and link information for each entry, which is
+    unnecessary for the regular files in a sparkles report.
+    """
+    st = path.stat()
+    info = tarfile.TarInfo(str(arcname))
+    info.size = st.st_size
+    info.mtime = int(st.st_mtime)
+    info.mode = st.st_mode & 0o7777
+    with path.open("rb") as fh:
+        tar.addfile(info, fh)
+
+
+def _freeze(value):
+    """
+    Hashable version of a proseco argument, used to compare sets of parameters.
+    """
+    if isinstance(value, Quat):
+        return tuple(value.q.tolist())
+    if isinstance(value, CxoTime):
+        return value.date
+    if isinstance(value, u.Quantity):
+        return _freeze(value.value), str(value.unit)
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(val)) for key, val in value.items()))
+    if hasattr(value, "tolist"):
+        value = value.tolist()
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(val) for val in value)
+    return value
+
+
 class CachedVal:
+    """
+    A value that is computed lazily in a worker process.
+
+    The computation starts on the first call to `submit`, and it starts again after `reset`.
+    Each instance has its own worker, so a computation never waits in the queue behind another
+    one that depends on it.
+    """
+
     def __init__(self, func):
         self._func = func
+        # Processes are spawned, not forked, because forking a process with running threads is
+        # not safe.
+        self._executor = ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        )
+        # the lock is reentrant because callbacks of finished futures run in the calling thread
+        self._lock = threading.RLock()
+        # self._future is the Future returned by submit, and self._job is the Future of the
+        # computation in the worker, which starts later if submit is called with `after`.
+        self._future = None
+        self._job = None
+
+    def close(self):
+        """
+        Cancel pending computations and stop the worker process.
+
+        A running computation is not waited for. The worker process only runs the computation,
+        so it is terminated.
+        """
         self.reset()
+        # the executor forgets its processes on shutdown
+        processes = list((self._executor._processes or {}).values())
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
 
     def reset(self):
-        self._value = utils.LazyVal(self._func)
+        with self._lock:
+            # a computation that has not started in the worker is not needed anymore
+            for future in (self._future, self._job):
+                if future is not None:
+                    future.cancel()
+            self._future = None
+            self._job = None
+
+    def submit(self, *args, after=None):
+        """
+        Start the computation if needed, and return the corresponding Future.
+
+        The arguments are passed to the function when the computation is submitted, so later
+        changes do not affect it. They are ignored if the computation was already submitted.
+
+        If `after` is a Future, the computation is submitted when `after` is done, and the result
+        of `after` is passed to the function before the other arguments.
+        """
+        with self._lock:
+            if self._future is None:
+                self._future = Future()
+                if after is None:
+                    self._start(self._future, args)
+                else:
+                    after.add_done_callback(
+                        functools.partial(self._start_after, self._future, args)
+                    )
+            return self._future
 
     @property
-    def val(self):
-        return self._value.val
+    def future(self):
+        return self._future
+
+    def _start(self, future, args):
+        self._job = self._executor.submit(self._func, *args)
+        self._job.add_done_callback(functools.partial(self._finish, future))
+
+    def _start_after(self, future, args, after):
+        with self._lock:
+            # the value was reset while waiting
+            if future is not self._future:
+                return
+            if after.cancelled():
+                future.cancel()
+            elif after.exception() is not None:
+                future.set_exception(after.exception())
+            else:
+                self._start(future, (after.result(),) + args)
+
+    def _finish(self, future, job):
+        with self._lock:
+            # the value was reset while computing
+            if future.cancelled():
+                return
+            if job.cancelled():
+                future.cancel()
+            elif job.exception() is not None:
+                future.set_exception(job.exception())
+            else:
+                future.set_result(job.result())
 
 
 class Data:
     def __init__(self, parameters=None) -> None:
-        self._proseco = CachedVal(self.run_proseco)
-        self._sparkles = CachedVal(self.run_sparkles)
+        # proseco and sparkles read the AGASC in worker processes, because the star field reads
+        # it in this process at the same time, and HDF5 is not thread-safe.
+        self._proseco = CachedVal(compute_catalog)
+        self._sparkles = CachedVal(run_sparkles_review)
         self.parameters = parameters
+        self._parameters_key = None if parameters is None else _freeze(parameters)
         self._tmp_dir = TemporaryDirectory()
         self._dir = Path(self._tmp_dir.name)
 
-    def reset(self, parameters):
+    def reset(self, parameters, force=False):
+        # keep the cached catalog if the parameters did not really change
+        key = None if parameters is None else _freeze(parameters)
+        if not force and key is not None and key == self._parameters_key:
+            return
+        self._parameters_key = key
         self.parameters = parameters
         self._proseco.reset()
         self._sparkles.reset()
 
+    def close(self):
+        """
+        Stop the workers and remove the temporary directory.
+        """
+        # the workers are terminated, so nothing writes into the directory while it is removed
+        self._proseco.close()
+        self._sparkles.close()
+        self._tmp_dir.cleanup()
+
     @property
     def proseco(self):
-        return self._proseco.val
+        return self.submit_proseco().result()
 
     @property
     def sparkles(self):
-        return self._sparkles.val
+        return self.submit_sparkles().result()
+
+    @property
+    def proseco_future(self):
+        return self._proseco.future
+
+    @property
+    def sparkles_future(self):
+        return self._sparkles.future
+
+    def submit_proseco(self):
+        return self._proseco.submit(self.parameters)
+
+    def submit_sparkles(self):
+        # sparkles gets the proseco run current at this time, not the one after a reset.
+        # The report directory is reused, so old reports do not pile up (or get exported).
+        # There is a single worker, so two reviews never write there at the same time.
+        return self._sparkles.submit(self._dir / "sparkles", after=self.submit_proseco())
 
     def export_proseco(self, outfile):
-        if self.proseco:
+        catalog = self.proseco
+        if catalog:
             outfile = self._dir / outfile
-            catalog = self.proseco["catalog"]
-            if catalog:
-                with open(outfile, "wb") as fh:
-                    pickle.dump({catalog.obsid: catalog}, fh)
+            with open(outfile, "wb") as fh:
+                pickle.dump(
+                    {catalog.obsid: catalog}, fh, protocol=pickle.HIGHEST_PROTOCOL
+                )
 
     def export_sparkles(self, outfile):
         if self.sparkles:
             outfile = self._dir / outfile
             if self.sparkles:
-                dest = Path(outfile.name.replace(".tar", "").replace(".gz", ""))
-                with tarfile.open(outfile, "w") as tar:
-                    for name in self.sparkles.glob("**/*"):
-                        tar.add(
-                            name,
-                            arcname=dest / name.relative_to(self._dir / "sparkles"),
-                        )
-
-    def run_proseco(self):
-        if self.parameters:
-            catalog = get_aca_catalog(**self.parameters)
-            aca = catalog.get_review_table()
-            sparkles.core.check_catalog(aca)
-
-            return {
-                "catalog": catalog,
-                "aca": aca,
-            }
-        return {}
-
-    def run_sparkles(self):
-        if self.proseco and self.proseco["catalog"]:
-            sparkles.run_aca_review(
-                "Exploration",
-                acars=[self.proseco["catalog"].get_review_table()],
-                report_dir=self._dir / "sparkles",
-                report_level="all",
-                roll_level="none",
-            )
-            return self._dir / "sparkles"
+                dest = Path(outfile.name)
+                while dest.suffix in (".tgz", ".tar", ".gz"):
+                    dest = dest.with_suffix("")
+                # the report is mostly text, so the fastest compression level is good enough
+                with tarfile.open(outfile, "w:gz", compresslevel=1) as tar:
+                    # only files are added, and without recursion. Adding directories
+                    # would add every file underneath them a second time.
+                    for root, _dirs, files in os.walk(self.sparkles):
+                        for filename in files:
+                            name = Path(root) / filename
+                            _add_file_to_tar(
+                                tar, name, dest / name.relative_to(self.sparkles)
+                            )
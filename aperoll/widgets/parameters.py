@@ -1,19 +1,32 @@
-import gzip
 import json
-import pickle
+import logging
+import time
+from contextlib import contextmanager
 from pprint import pformat
 
-import maude
-import numpy as np
 import Ska.Sun as sun
 from astropy import units as u
 from cxotime.cxotime import CxoTime
-from kadi.commands.observations import get_detector_and_sim_offset
 from PyQt5 import QtCore as QtC
 from PyQt5 import QtWidgets as QtW
 from Quaternion import Quat
 
-from aperoll.utils import AperollException, logger
+from aperoll.utils import AperollException, load_catalogs, logger
+
+try:
+    # orjson is an optional dependency. It parses large Yoshi files much faster.
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+
+# proseco arguments that are only passed when they are not empty
+_STAR_ID_ARGS = (
+    "exclude_ids_guide",
+    "include_ids_guide",
+    "exclude_ids_acq",
+    "include_ids_acq",
+)
 
 
 class LineEdit(QtW.QLineEdit):
@@ -48,10 +61,42 @@ class LineEdit(QtW.QLineEdit):
             self.value_changed.emit(self.text())
 
 
+# telemetry values used for the default parameters are cached for this many seconds
+DEFAULT_PARAMETERS_TTL = 60
+
+_DEFAULT_PARAMETERS_CACHE = {"time": None, "value": None}
+
+
 def get_default_parameters():
     """
     Get default initial parameters from current telemetry.
+
+    Telemetry is fetched from MAUDE at most once every DEFAULT_PARAMETERS_TTL seconds. The date is
+    always the current time. Call `clear_default_parameters_cache` to force a new fetch.
+    """
+    now = time.monotonic()
+    cache = _DEFAULT_PARAMETERS_CACHE
+    if cache["value"] is None or now - cache["time"] > DEFAULT_PARAMETERS_TTL:
+        cache["value"] = _get_default_parameters_from_telemetry()
+        cache["time"] = now
+
+    result = {"date": CxoTime().date}
+    result.update(cache["value"])
+    return result
+
+
+def clear_default_parameters_cache():
     """
+    Make the next call to `get_default_parameters` fetch telemetry again.
+    """
+    _DEFAULT_PARAMETERS_CACHE["time"] = None
+    _DEFAULT_PARAMETERS_CACHE["value"] = None
+
+
+def _get_default_parameters_from_telemetry():
+    # maude and kadi are slow to import and only needed here
+    import maude
+    from kadi.commands.observations import get_detector_and_sim_offset
 
     msid_list = ["3TSCPOS", "AACCCDPT"] + [f"aoattqt{i}".upper() for i in range(1, 5)]
     msids = maude.get_msids(msid_list)
@@ -62,7 +107,6 @@ def get_default_parameters():
     t_ccd = (data["AACCCDPT"] - 32) * 5 / 9
 
     result = {
-        "date": CxoTime().date,
         "attitude": q,
         "ra": q.ra,
         "dec": q.dec,
@@ -88,8 +132,8 @@ def get_parameters_from_yoshi(filename, obsid=None):
     Get initial parameters from a Yoshi JSON file.
     """
 
-    with open(filename) as fh:
-        contents = json.load(fh)
+    with open(filename, "rb") as fh:
+        contents = json_loads(fh.read())
         if obsid is not None:
             contents = [obs for obs in contents if obs["obsid"] == obsid]
             if not contents:
@@ -121,9 +165,9 @@ def get_parameters_from_yoshi(filename, obsid=None):
         yoshi_params["n_fid"] = "0"
         yoshi_params["n_guide"] = "8"
 
-    att = Quat(
-        equatorial=(yoshi_params["ra"], yoshi_params["dec"], yoshi_params["roll"])
-    )
+    # ra/dec/roll are always set above, so there is no need to fall back to the defaults
+    ra, dec, roll = yoshi_params["ra"], yoshi_params["dec"], yoshi_params["roll"]
+    att = Quat(equatorial=(ra, dec, roll))
 
     default = get_default_parameters()
     parameters = {
@@ -139,9 +183,9 @@ def get_parameters_from_yoshi(filename, obsid=None):
         ),
         "date": yoshi_params.get("date", default["date"]),
         "attitude": att,
-        "ra": yoshi_params.get("ra", default["attitude"].ra),
-        "dec": yoshi_params.get("dec", default["attitude"].dec),
-        "roll": yoshi_params.get("roll", default["attitude"].roll),
+        "ra": ra,
+        "dec": dec,
+        "roll": roll,
         "t_ccd": yoshi_params.get("t_ccd", default["t_ccd"]),
         "instrument": yoshi_params.get("instrument", default["instrument"]),
         "n_guide": yoshi_params["n_guide"],
@@ -154,16 +198,14 @@ def get_parameters_from_pickle(filename, obsid=None):
     """
     Get initial parameters from a proseco pickle file.
     """
-    open_fcn = open if filename.endswith(".pkl") else gzip.open
-    with open_fcn(filename, "rb") as fh:
-        catalogs = pickle.load(fh)
+    catalogs = load_catalogs(filename)
 
     if not catalogs:
         raise AperollException(f"No entries found in {filename}")
 
     if obsid is None:
         # this is ugly but it works whether the keys are strings of floats or ints
-        obsid = int(np.round(float(list(catalogs.keys())[0])))
+        obsid = int(round(float(next(iter(catalogs)))))
 
     if float(obsid) not in catalogs:
         raise AperollException(f"OBSID {obsid} not found in {filename}")
@@ -228,6 +270,10 @@ class Parameters(QtW.QWidget):
         self.dither_acq_z_edit = LineEdit(self)
         self.dither_guide_y_edit = LineEdit(self)
         self.dither_guide_z_edit = LineEdit(self)
+        self.values = {}
+        self._time_cache = (None, None)
+        self._batch_depth = 0
+        self._batch_changed = False
 
         self.date_edit.value_changed.connect(self._values_changed)
         self.obsid_edit.value_changed.connect(self._values_changed)
@@ -359,21 +405,24 @@ class Parameters(QtW.QWidget):
             if "obsid" in kwargs:
                 params["obsid"] = kwargs["obsid"]
 
-        logger.debug(pformat(params))
-        self.obsid_edit.setText(f"{params['obsid']}")
-        self.man_angle_edit.setText(f"{params['man_angle']}")
-        self.dither_acq_y_edit.setText(f"{params['dither_acq_y']}")
-        self.dither_acq_z_edit.setText(f"{params['dither_acq_z']}")
-        self.dither_guide_y_edit.setText(f"{params['dither_guide_y']}")
-        self.dither_guide_z_edit.setText(f"{params['dither_guide_z']}")
-        self.date_edit.setText(kwargs.get("date", params["date"]))
-        self.ra_edit.setText(f"{params['ra']:.5f}")
-        self.dec_edit.setText(f"{params['dec']:.5f}")
-        self.roll_edit.setText(f"{params['roll']:.5f}")
-        self.n_guide_edit.setText(f"{params['n_guide']}")
-        self.n_fid_edit.setText(f"{params['n_fid']}")
-        self.n_t_ccd_edit.setText(f"{params['t_ccd']:.2f}")
-        self.instrument_edit.setCurrentText(params["instrument"])
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(pformat(params))
+        # all fields change at once, so parameters_changed is emitted only once
+        with self._batched_changes():
+            self.obsid_edit.setText(f"{params['obsid']}")
+            self.man_angle_edit.setText(f"{params['man_angle']}")
+            self.dither_acq_y_edit.setText(f"{params['dither_acq_y']}")
+            self.dither_acq_z_edit.setText(f"{params['dither_acq_z']}")
+            self.dither_guide_y_edit.setText(f"{params['dither_guide_y']}")
+            self.dither_guide_z_edit.setText(f"{params['dither_guide_z']}")
+            self.date_edit.setText(kwargs.get("date", params["date"]))
+            self.ra_edit.setText(f"{params['ra']:.5f}")
+            self.dec_edit.setText(f"{params['dec']:.5f}")
+            self.roll_edit.setText(f"{params['roll']:.5f}")
+            self.n_guide_edit.setText(f"{params['n_guide']}")
+            self.n_fid_edit.setText(f"{params['n_fid']}")
+            self.n_t_ccd_edit.setText(f"{params['t_ccd']:.2f}")
+            self.instrument_edit.setCurrentText(params["instrument"])
 
         self.values = self._validate()
 
@@ -382,10 +431,34 @@ class Parameters(QtW.QWidget):
         if self.values:
             self.draw_test.emit()
 
+    @contextmanager
+    def _batched_changes(self):
+        """
+        Context manager to make several changes with a single parameters_changed signal.
+
+        The signal is emitted when leaving the outermost context, and only if something changed.
+        """
+        self._batch_depth += 1
+        try:
+            yield
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0 and self._batch_changed:
+                self._batch_changed = False
+                self._values_changed()
+
     def _values_changed(self):
+        if self._batch_depth > 0:
+            self._batch_changed = True
+            return
+        values = self._validate(quiet=True)
+        # text changes that do not change the values (e.g. "16" -> "16.0") are not propagated,
+        # because listeners discard the current catalog and might compute a new one.
+        if values and values == self.values:
+            return
         # values are empty if validation fails, but the signal is still emitted to notify anyone
         # that the values have changed
-        self.values = self._validate(quiet=True)
+        self.values = values
         self.parameters_changed.emit()
 
     def _validate(self, quiet=False):
@@ -399,7 +472,7 @@ class Parameters(QtW.QWidget):
             assert n_fid + n_guide == 8, "n_fid + n_guide != 8"
             ra = float(self.ra_edit.text()) * u.deg
             dec = float(self.dec_edit.text()) * u.deg
-            time = CxoTime(self.date_edit.text())
+            time = self._get_time(self.date_edit.text())
             if self.roll_edit.text() == "":
                 roll = sun.nominal_roll(ra, dec, time)
             else:
@@ -445,26 +518,36 @@ class Parameters(QtW.QWidget):
                 logger.warning(e)
             return {}
 
+    def _get_time(self, date):
+        # parsing dates is slow, and the same date is parsed on every parameter change
+        if date != self._time_cache[0]:
+            self._time_cache = (date, CxoTime(date))
+        return self._time_cache[1]
+
     def _do_it(self):
         self.values = self._validate()
         if self.values:
             self.do_it.emit()
 
     def set_ra_dec(self, ra, dec, roll):
-        self.ra_edit.setText(f"{ra:.8f}")
-        self.dec_edit.setText(f"{dec:.8f}")
-        self.roll_edit.setText(f"{roll:.8f}")
+        # batched, otherwise each edit would trigger a full update (with intermediate attitudes)
+        with self._batched_changes():
+            self.ra_edit.setText(f"{ra:.8f}")
+            self.dec_edit.setText(f"{dec:.8f}")
+            self.roll_edit.setText(f"{roll:.8f}")
 
     def include_star(self, star, type, include):
-        if include is True:
-            self._include_star(star, type, True)
-            self._exclude_star(star, type, False)
-        elif include is False:
-            self._include_star(star, type, False)
-            self._exclude_star(star, type, True)
-        else:
-            self._include_star(star, type, include=False)
-            self._exclude_star(star, type, exclude=False)
+        # moving a star between lists is a single change
+        with self._batched_changes():
+            if include is True:
+                self._include_star(star, type, True)
+                self._exclude_star(star, type, False)
+            elif include is False:
+                self._include_star(star, type, False)
+                self._exclude_star(star, type, True)
+            else:
+                self._include_star(star, type, include=False)
+                self._exclude_star(star, type, exclude=False)
 
     def _include_star(self, star, type, include):
         items = self.include[type].findItems(f"{star}", QtC.Qt.MatchExactly)
@@ -488,7 +571,7 @@ class Parameters(QtW.QWidget):
         obsid = self.values["obsid"]
         ra, dec = self.values["ra"], self.values["dec"]
         roll = self.values["roll"]
-        time = CxoTime(self.values["date"])
+        time = self._get_time(self.values["date"])
 
         aca_attitude = Quat(equatorial=(float(ra / u.deg), float(dec / u.deg), roll))
 
@@ -509,13 +592,8 @@ class Parameters(QtW.QWidget):
             "dyn_bgd_n_faint": 2,
         }
 
-        for key in [
-            "exclude_ids_guide",
-            "include_ids_guide",
-            "exclude_ids_acq",
-            "include_ids_acq",
-        ]:
-            if self.values[key]:
-                args[key] = self.values[key]
+        args.update(
+            {key: self.values[key] for key in _STAR_ID_ARGS if self.values[key]}
+        )
 
         return args
@@ -1,3 +1,7 @@
+import functools
+import math
+import os
+from contextlib import contextmanager
 from dataclasses import dataclass, replace
 
 import agasc
@@ -6,6 +10,7 @@ import tables
 from astropy import units as u
 from astropy.table import Table, vstack
 from cxotime import CxoTime
+from proseco.acq import get_acq_candidates_mask
 from PyQt5 import QtCore as QtC
 from PyQt5 import QtGui as QtG
 from PyQt5 import QtWidgets as QtW
@@ -17,6 +22,7 @@ from aperoll.star_field_items import (
     Centroid,
     FieldOfView,
     Star,
+    qpolygonf,
     star_field_position,
 )
 
@@ -81,6 +87,28 @@ _COMMON_STATES = [
 ]
 
 
+@functools.cache
+def _camera_fov_frame_polygons():
+    """
+    Polygons for the edges of the CCD and for the quadrant boundaries.
+
+    The frame is constant, so the polygons are built only once.
+    """
+    frame = utils.get_camera_fov_frame()
+    return {key: qpolygonf(value["row"], value["col"]) for key, value in frame.items()}
+
+
+@functools.lru_cache(maxsize=4)
+def _get_healpix_info(agasc_file, _mtime):
+    """
+    The healpix index map and HEALPix object for an AGASC file.
+
+    These are read once per file (and modification time), not on every update of the stars.
+    """
+    healpix_index_map, nside = agasc.healpix.get_healpix_info(agasc_file)
+    return healpix_index_map, agasc.healpix.get_healpix(nside)
+
+
 class StarView(QtW.QGraphicsView):
     include_star = QtC.pyqtSignal(int, str, object)
     update_proseco = QtC.pyqtSignal()
@@ -97,8 +125,23 @@ class StarView(QtW.QGraphicsView):
         self._rotating = False
         self._moving = False
 
+        # mouse moves are accumulated and applied to the scene once the pending events are handled,
+        # so a burst of mouse events results in a single attitude update
+        self._pending_shift = (0.0, 0.0)
+        self._pending_rotation = (0.0, None)
+        self._move_timer = QtC.QTimer(self)
+        self._move_timer.setSingleShot(True)
+        self._move_timer.setInterval(0)
+        self._move_timer.timeout.connect(self._apply_pending_move)
+
         self._draw_frame = False
 
+        # size of the viewport in scene coordinates, it only changes on scaling or resizing
+        self._view_size = None
+        # the scale last applied to the star items, and the items it was applied to
+        self._item_scale = None
+        self._scaled_items = None
+
     def _get_draw_frame(self):
         return self._draw_frame
 
@@ -136,23 +179,44 @@ class StarView(QtW.QGraphicsView):
             start_pos = self.mapToScene(self._start)
             if self._moving:
                 dx, dy = end_pos.x() - start_pos.x(), end_pos.y() - start_pos.y()
-                self.scene().shift_scene(dx, dy)
+                self._pending_shift = (
+                    self._pending_shift[0] + dx,
+                    self._pending_shift[1] + dy,
+                )
             elif self._rotating:
                 center = self.mapToScene(self.viewport().rect().center())
                 x1 = start_pos.x() - center.x()
                 y1 = start_pos.y() - center.y()
                 x2 = end_pos.x() - center.x()
                 y2 = end_pos.y() - center.y()
-                r1 = np.sqrt(x1**2 + y1**2)
-                r2 = np.sqrt(x2**2 + y2**2)
-                angle = np.rad2deg(np.arcsin((x1 * y2 - x2 * y1) / (r1 * r2)))
-                self.scene().rotate_scene(angle, center)
+                r1 = math.hypot(x1, y1)
+                r2 = math.hypot(x2, y2)
+                # (there is no angle if one of the points is the center)
+                if r1 > 0 and r2 > 0:
+                    # clipped because rounding can take the sine slightly outside [-1, 1]
+                    sin = min(max((x1 * y2 - x2 * y1) / (r1 * r2), -1.0), 1.0)
+                    angle = math.degrees(math.asin(sin))
+                    self._pending_rotation = (self._pending_rotation[0] + angle, center)
 
             self._start = pos
+            if not self._move_timer.isActive():
+                self._move_timer.start()
+
+    def _apply_pending_move(self):
+        self._move_timer.stop()
+        dx, dy = self._pending_shift
+        angle, center = self._pending_rotation
+        self._pending_shift = (0.0, 0.0)
+        self._pending_rotation = (0.0, None)
+        if dx or dy:
+            self.scene().shift_scene(dx, dy)
+        if angle:
+            self.scene().rotate_scene(angle, center)
 
     def mouseReleaseEvent(self, event):
         if event.button() == QtC.Qt.LeftButton:
             self._start = None
+            self._apply_pending_move()
             if (self._moving or self._rotating) and self.scene().state.auto_proseco:
                 self.update_proseco.emit()
 
@@ -187,42 +251,24 @@ class StarView(QtW.QGraphicsView):
         anti_aliasing_set = painter.testRenderHint(QtG.QPainter.Antialiasing)
         painter.setRenderHint(QtG.QPainter.Antialiasing, True)
 
+        frame = _camera_fov_frame_polygons()
+
+        # The following draws the edges of the CCD
         black_pen = QtG.QPen()
         black_pen.setCosmetic(True)
         black_pen.setWidth(1)
-        center = QtC.QPoint(self.viewport().width() // 2, self.viewport().height() // 2)
-        center = self.mapToScene(center)
-
-        # The following draws the edges of the CCD
-        frame = utils.get_camera_fov_frame()
-
-        row, col = "row", "col"
         painter.setPen(black_pen)
-        for i in range(len(frame["edge_1"][row]) - 1):
-            painter.drawLine(
-                QtC.QPointF(frame["edge_1"][row][i], frame["edge_1"][col][i]),
-                QtC.QPointF(frame["edge_1"][row][i + 1], frame["edge_1"][col][i + 1]),
-            )
-        for i in range(len(frame["edge_2"][row]) - 1):
-            painter.drawLine(
-                QtC.QPointF(frame["edge_2"][row][i], frame["edge_2"][col][i]),
-                QtC.QPointF(frame["edge_2"][row][i + 1], frame["edge_2"][col][i + 1]),
-            )
+        painter.drawPolyline(frame["edge_1"])
+        painter.drawPolyline(frame["edge_2"])
 
+        # and the quadrant boundaries
         magenta_pen = QtG.QPen(QtG.QColor("magenta"))
         magenta_pen.setCosmetic(True)
         magenta_pen.setWidth(1)
         painter.setPen(magenta_pen)
-        for i in range(len(frame["cross_2"][row]) - 1):
-            painter.drawLine(
-                QtC.QPointF(frame["cross_2"][row][i], frame["cross_2"][col][i]),
-                QtC.QPointF(frame["cross_2"][row][i + 1], frame["cross_2"][col][i + 1]),
-            )
-        for i in range(len(frame["cross_1"][row]) - 1):
-            painter.drawLine(
-                QtC.QPointF(frame["cross_1"][row][i], frame["cross_1"][col][i]),
-                QtC.QPointF(frame["cross_1"][row][i + 1], frame["cross_1"][col][i + 1]),
-            )
+        painter.drawPolyline(frame["cross_2"])
+        painter.drawPolyline(frame["cross_1"])
+
         painter.setRenderHint(QtG.QPainter.Antialiasing, anti_aliasing_set)
 
     def contextMenuEvent(self, event):  # noqa: PLR0912, PLR0915
@@ -332,6 +378,7 @@ class StarView(QtW.QGraphicsView):
 
     def resizeEvent(self, event):
         super().resizeEvent(event)
+        self._view_size = None
         if event.oldSize().width() == -1 and event.oldSize().height() == -1:
             # this fits the viewport to a circle of radius 7200 arcsec plus some margin
             # (this assumes the scene is in pixels, where the diagonal of the CCD is ~1400 pixels)
@@ -343,26 +390,30 @@ class StarView(QtW.QGraphicsView):
         mags = [14, 11, 10.3, 9, 9.5, 8, 7, 3]
 
         if self.scene()._stars is not None:
-            tl = self.mapToScene(self.viewport().rect().topLeft())
-            br = self.mapToScene(self.viewport().rect().bottomRight())
-
-            side = max(np.abs(tl.x() - br.x()), np.abs(tl.y() - br.y()))
-            radius = 1.5 * (side / 2) * 5 / 3600  # 5 arcsec per pixel, radius in degree
+            radius = self.get_view_radius()
 
-            r = agasc.sphere_dist(
-                self.scene().attitude.ra,
-                self.scene().attitude.dec,
-                self.scene()._stars["RA_PMCORR"],
-                self.scene()._stars["DEC_PMCORR"],
-            )
+            # instead of the angular distance to each star, compare the cosine of the distance
+            # (the dot product of the unit vectors) with the cosine of the radius
+            ra = np.radians(self.scene().attitude.ra)
+            dec = np.radians(self.scene().attitude.dec)
+            center = [np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)]
             max_mag = mags[np.digitize(radius, r_threshold)]
-            hide = (r > radius) | (self.scene()._stars["MAG_ACA"] > max_mag)
-            for idx, item in enumerate(self.scene()._stars):
-                # note that the coordinate system is (row, -col), which is (-yag, -zag)
-                if hide[idx]:
-                    item["graphic_item"].hide()
-                else:
-                    item["graphic_item"].show()
+            # stars are sorted by magnitude, so the ones bright enough to show are the first
+            # n_bright, and only those need the distance check
+            n_bright = np.searchsorted(self.scene()._star_mags, max_mag, side="right")
+            hide = np.ones(len(self.scene()._star_mags), dtype=bool)
+            cos_r = self.scene()._star_xyz[:n_bright] @ center
+            hide[:n_bright] = cos_r < np.cos(np.radians(radius))
+            # only the items that changed since the last call are shown/hidden
+            prev_hide = self.scene()._star_hidden
+            if prev_hide is None:
+                changed = np.arange(len(hide))
+            else:
+                changed = np.flatnonzero(hide != prev_hide)
+            items = self.scene()._star_items
+            for idx in changed.tolist():
+                items[idx].setVisible(not hide[idx])
+            self.scene()._star_hidden = hide
 
             self.scene().show_fov(radius < 6)
             self.scene().show_alternate_fov(radius < 6)
@@ -375,28 +426,46 @@ class StarView(QtW.QGraphicsView):
             # this breaks the view/scene separation, but it works for us.
             threshold = 0.15
             new_scale = np.sqrt(self.transform().determinant())
-            for item in self.scene()._stars["graphic_item"]:
-                item.setScale(threshold / new_scale if new_scale < threshold else 1)
+            item_scale = threshold / new_scale if new_scale < threshold else 1
+            items = self.scene()._star_items
+            # nothing to do if neither the scale nor the items changed
+            # (_star_items is a new list whenever stars are added or removed)
+            if item_scale == self._item_scale and items is self._scaled_items:
+                return
+            for item in items:
+                item.setScale(item_scale)
+            self._item_scale = item_scale
+            self._scaled_items = items
+
+    def get_view_size(self):
+        """
+        Width and height of the viewport in scene coordinates (pixels).
+        """
+        if self._view_size is None:
+            tl = self.mapToScene(self.viewport().rect().topLeft())
+            br = self.mapToScene(self.viewport().rect().bottomRight())
+            self._view_size = (np.abs(tl.x() - br.x()), np.abs(tl.y() - br.y()))
+        return self._view_size
+
+    def get_view_radius(self):
+        """
+        Radius (in degrees) of the region where stars are shown.
+        """
+        side = max(self.get_view_size()) / 2
+        return 1.5 * side * 5 / 3600  # 5 arcsec per pixel, radius in degree
 
     def scale(self, sx, sy):
         # refusing to scale beyond 15 degrees
-        tl = self.mapToScene(self.viewport().rect().topLeft())
-        br = self.mapToScene(self.viewport().rect().bottomRight())
-        width = np.abs(tl.x() - br.x())
-        height = np.abs(tl.y() - br.y())
+        width, height = self.get_view_size()
         if (width * 5 / 3600 / sx >= 15) or (height * 5 / 3600 / sy >= 15):
             return
 
         # scale
         super().scale(sx, sy)
+        self._view_size = None
 
         # now tell the scene the new radius for updating stars
-        tl = self.mapToScene(self.viewport().rect().topLeft())
-        br = self.mapToScene(self.viewport().rect().bottomRight())
-
-        side = max(np.abs(tl.x() - br.x()), np.abs(tl.y() - br.y())) / 2
-        radius = 1.5 * side * 5 / 3600  # 5 arcsec per pixel, radius in degree
-        self.scene().update_stars(radius=radius)
+        self.scene().update_stars(radius=self.get_view_radius())
 
 
 class StarField(QtW.QGraphicsScene):
@@ -407,13 +476,26 @@ class StarField(QtW.QGraphicsScene):
         super().__init__(parent)
 
         self._attitude = None
+        # the quaternion components of _attitude, to compare attitudes without numpy
+        self._attitude_q = None
         self._time = None
         self._stars = None
+        # the graphic items in self._stars, kept as a list because iterating over a Table is slow
+        self._star_items = []
+        # visibility flags of the items in _star_items, as set by StarView.set_visibility
+        self._star_hidden = None
+        # unit vectors and magnitudes of the stars, used by StarView.set_visibility
+        # (stars are kept sorted by magnitude)
+        self._star_xyz = None
+        self._star_mags = None
 
         self.catalog = Catalog()
         self.addItem(self.catalog)
 
-        self._healpix_indices = set()
+        # flags for the healpix pixels whose stars are loaded, indexed by healpix index
+        self._healpix_loaded = None
+        self._batch_depth = 0
+        self._stars_outdated = False
         self._update_radius = 2
 
         # alternate fov added first so it never hides the main fov
@@ -456,64 +538,104 @@ class StarField(QtW.QGraphicsScene):
 
     state = property(get_state, set_state)
 
+    @contextmanager
+    def batched_updates(self):
+        """
+        Context manager to make several changes (e.g. attitude and time) with a single star update.
+
+        The stars are updated when leaving the outermost context, and only if something changed.
+        """
+        self._batch_depth += 1
+        try:
+            yield
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0 and self._stars_outdated:
+                self._stars_outdated = False
+                self.update_stars()
+
     def update_stars(self, radius=None):
         if radius is not None:
             self._update_radius = radius
 
+        if self._batch_depth > 0:
+            self._stars_outdated = True
+            return
+
         if self._attitude is None or self._time is None:
             return
 
-        agasc_file = agasc.paths.default_agasc_file()
+        agasc_file = str(agasc.paths.default_agasc_file())
 
         # Table of healpix, idx0, idx1 where idx is the index into main AGASC data table
-        healpix_index_map, nside = agasc.healpix.get_healpix_info(agasc_file)
-        hp = agasc.healpix.get_healpix(nside)
-
-        # We include stars in healpix pixels intersecting a cone with the given radius
-        healpix_indices = set(
-            hp.cone_search_lonlat(
-                self._attitude.ra * u.deg,
-                self._attitude.dec * u.deg,
-                radius=self._update_radius * u.deg,
-            )
+        healpix_index_map, hp = _get_healpix_info(
+            agasc_file, os.path.getmtime(agasc_file)
         )
-        add_indices = list(set(healpix_indices) - self._healpix_indices)
-
-        # and we only remove them when they fall out of a larger cone
-        # (to allow for panning without adding and dro[[ing repeatedly)
-        healpix_indices = set(
-            hp.cone_search_lonlat(
-                self.attitude.ra * u.deg,
-                self.attitude.dec * u.deg,
-                radius=(self._update_radius * 1.5) * u.deg,
-            )
+
+        # We only remove stars when they fall out of a cone 1.5 times the given radius
+        # (to allow for panning without adding and dropping repeatedly)
+        outer_indices = hp.cone_search_lonlat(
+            self._attitude.ra * u.deg,
+            self._attitude.dec * u.deg,
+            radius=(self._update_radius * 1.5) * u.deg,
+        )
+        if self._healpix_loaded is None or len(self._healpix_loaded) != hp.npix:
+            self._healpix_loaded = np.zeros(hp.npix, dtype=bool)
+        in_outer = np.zeros(hp.npix, dtype=bool)
+        in_outer[outer_indices] = True
+        remove_pixels = self._healpix_loaded & ~in_outer
+
+        # and we include stars in healpix pixels intersecting a cone with the given radius
+        add_indices = hp.cone_search_lonlat(
+            self._attitude.ra * u.deg,
+            self._attitude.dec * u.deg,
+            radius=self._update_radius * u.deg,
         )
-        remove_indices = list(self._healpix_indices - set(healpix_indices))
+        add_indices = add_indices[~self._healpix_loaded[add_indices]].tolist()
 
         # remove stars
-        if self._stars is not None:
-            for star in self._stars[
-                np.in1d(self._stars["healpix_idx"], remove_indices)
-            ]:
-                self.removeItem(star["graphic_item"])
-            self._stars = self._stars[
-                ~np.in1d(self._stars["healpix_idx"], remove_indices)
-            ]
+        # (usually there is nothing to remove, so the mask is computed only if needed)
+        if self._stars is not None and remove_pixels.any():
+            remove = remove_pixels[self._stars["healpix_idx"]]
+            for item in self._stars["graphic_item"][remove]:
+                self.removeItem(item)
+            self._stars = self._stars[~remove]
+            self._set_star_arrays()
 
         # add stars
         if add_indices:
-            stars_list = []
+            # pixels are read in file order, and the row ranges of neighboring pixels are merged,
+            # so contiguous pixels are read in one go
+            add_indices = sorted(add_indices, key=lambda idx: healpix_index_map[idx][0])
+            row_ranges = []
+            for healpix_index in add_indices:
+                idx0, idx1 = healpix_index_map[healpix_index]
+                if row_ranges and row_ranges[-1][1] == idx0:
+                    row_ranges[-1][1] = idx1
+                else:
+                    row_ranges.append([idx0, idx1])
+
+            # the rows are concatenated as plain arrays, and the Table is created only once
             with tables.open_file(agasc_file) as h5:
-                for healpix_index in add_indices:
-                    idx0, idx1 = healpix_index_map[healpix_index]
-                    stars = Table(agasc.read_h5_table(h5, row0=idx0, row1=idx1))
-                    stars["healpix_idx"] = healpix_index
-                    stars_list.append(stars)
+                stars_list = [
+                    agasc.read_h5_table(h5, row0=idx0, row1=idx1)
+                    for idx0, idx1 in row_ranges
+                ]
 
             stars = Table(np.concatenate(stars_list))
+            n_rows = [
+                healpix_index_map[idx][1] - healpix_index_map[idx][0]
+                for idx in add_indices
+            ]
+            stars["healpix_idx"] = np.repeat(add_indices, n_rows)
             agasc.add_pmcorr_columns(stars, self._time)
 
-            stars["graphic_item"] = [Star(star, highlight=False) for star in stars]
+            # acquisition candidates are found for all new stars at once, not star by star
+            bad = ~np.asarray(get_acq_candidates_mask(stars))
+            stars["graphic_item"] = [
+                Star(star, highlight=False, bad=is_bad)
+                for star, is_bad in zip(stars, bad.tolist(), strict=True)
+            ]
             for item in stars["graphic_item"]:
                 # item.setScale(self._scale)
                 self.addItem(item)
@@ -522,12 +644,28 @@ class StarField(QtW.QGraphicsScene):
                 self._stars = stars
             else:
                 self._stars = vstack([self._stars, stars])
+            self._stars = self._stars[np.argsort(self._stars["MAG_ACA"], kind="stable")]
+            self._set_star_arrays()
 
         # reset current indices
-        self._healpix_indices = set(np.unique(self._stars["healpix_idx"]))
+        self._healpix_loaded &= in_outer
+        self._healpix_loaded[add_indices] = True
 
         self.set_star_positions()
 
+    def _set_star_arrays(self):
+        """
+        Update the per-star arrays that are kept next to the stars Table.
+        """
+        self._star_items = list(self._stars["graphic_item"])
+        self._star_hidden = None
+        ra = np.radians(np.asarray(self._stars["RA_PMCORR"], dtype=float))
+        dec = np.radians(np.asarray(self._stars["DEC_PMCORR"], dtype=float))
+        self._star_xyz = np.column_stack(
+            [np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)]
+        )
+        self._star_mags = np.asarray(self._stars["MAG_ACA"], dtype=float)
+
     def add_test_stars(self):
         # this draws two circles, a blue one at (0, 0) and a red one at the CCD origin,
         # which corresponds to the ACA pointing. This is useful for debugging.
@@ -579,8 +717,11 @@ class StarField(QtW.QGraphicsScene):
                 ra=self._stars["RA_PMCORR"],
                 dec=self._stars["DEC_PMCORR"],
             )
-            for idx, item in enumerate(self._stars):
-                item["graphic_item"].setPos(x[idx], y[idx])
+            # plain python floats are faster to pass to Qt than numpy scalars
+            for item, x_i, y_i in zip(
+                self._star_items, x.tolist(), y.tolist(), strict=True
+            ):
+                item.setPos(x_i, y_i)
 
     def set_time(self, time):
         if time != self._time:
@@ -599,8 +740,8 @@ class StarField(QtW.QGraphicsScene):
         """
         Set the attitude of the scene, rotating the items to the given attitude.
         """
-
-        if attitude != self._attitude:
+        attitude_q = None if attitude is None else tuple(attitude.q.tolist())
+        if attitude_q != self._attitude_q:
             if self.catalog is not None:
                 self.catalog.set_pos_for_attitude(attitude)
 
@@ -616,6 +757,7 @@ class StarField(QtW.QGraphicsScene):
                 self.alternate_fov.set_pos_for_attitude(attitude)
 
             self._attitude = attitude
+            self._attitude_q = attitude_q
             self.update_stars()
             self.attitude_changed.emit()
 
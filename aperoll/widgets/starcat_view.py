@@ -1,6 +1,5 @@
 # from PyQt5 import QtCore as QtC, QtWidgets as QtW, QtGui as QtG
 import PyQt5.QtGui as QtG
-import PyQt5.QtWebEngineWidgets as QtWe
 import PyQt5.QtWidgets as QtW
 from PyQt5 import QtCore as QtC
 
@@ -68,23 +67,6 @@ span.monospace {
 """
 
 
-class WebPage(QtWe.QWebEnginePage):
-    def __init__(self, parent=None):
-        super().__init__(parent)
-
-    # trick from https://stackoverflow.com/questions/54920726/how-make-any-link-blank-open-in-same-window-using-qwebengine
-    def createWindow(self, _type):
-        page = WebPage(self)
-        page.urlChanged.connect(self.on_url_changed)
-        return page
-
-    @QtC.pyqtSlot(QtC.QUrl)
-    def on_url_changed(self, url):
-        page = self.sender()
-        self.setUrl(url)
-        page.deleteLater()
-
-
 class StarcatView(QtW.QTextEdit):
     def __init__(self, catalog=None, parent=None):
         super().__init__(parent)
@@ -111,10 +93,10 @@ class StarcatView(QtW.QTextEdit):
             "maxmag   yang    zang   row    col   dim res halfw"
         )
         n_lines = 35
-        scale_x = float(0.9 * self.width()) / QtG.QFontMetrics(font).width(header)
-        scale_y = float(0.9 * self.height()) / (
-            n_lines * QtG.QFontMetrics(font).height()
-        )
+        # one QFontMetrics per resize (horizontalAdvance replaces the deprecated width)
+        metrics = QtG.QFontMetrics(font)
+        scale_x = float(0.9 * self.width()) / metrics.horizontalAdvance(header)
+        scale_y = float(0.9 * self.height()) / (n_lines * metrics.height())
         pix_size = int(font.pixelSize() * min(scale_x, scale_y))
         if pix_size > 0:
             font.setPixelSize(pix_size)
@@ -8,7 +8,7 @@ setup(
     author="Javier Gonzalez",
     description="Proseco with Aperoll make a nice spritz",
     author_email="javier.gonzalez@cfa.harvard.edu",
-    packages=["aperoll", "aperoll.scripts", "aperoll.widgets"],
+    packages=["aperoll", "aperoll.scripts", "aperoll.tests", "aperoll.widgets"],
     license=(
         "New BSD/3-clause BSD License\nCopyright (c) 2021"
         " Smithsonian Astrophysical Observatory\nAll rights reserved."